@@ -0,0 +1,34 @@
+class ConversationHistory:
+    """
+    議論の履歴を保持するクラス
+    (発言者, 発言) と、まとめ用に整形済みの行を発言ごとに追記していく
+    """
+
+    def __init__(self):
+        self.entries: list[tuple[str, str]] = []
+        self._lines: list[str] = []
+
+    @classmethod
+    def from_entries(cls, entries: list[tuple[str, str]]) -> "ConversationHistory":
+        """
+        保存しておいた (発言者, 発言) のリストから復元する
+        """
+        history = cls()
+        for sender, text in entries:
+            history.append(sender, text)
+        return history
+
+    def append(self, sender: str, text: str):
+        self.entries.append((sender, text))
+        self._lines.append(f"{sender}: {text}")
+
+    @property
+    def last_text(self) -> str:
+        return self.entries[-1][1]
+
+    def joined(self, last: int | None = None) -> str:
+        """
+        整形済みの行を結合して返す（last を指定すると直近の発言のみ）
+        """
+        lines = self._lines if last is None else self._lines[-last:]
+        return "\n\n".join(lines)
@@ -0,0 +1,278 @@
+import os
+import time
+import asyncio
+import hashlib
+import functools
+from typing import Iterator
+import aiosqlite
+import numpy as np
+import zstandard
+
+from text_embedding import TextEmbedder
+
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+SEMANTIC_CACHE_TTL_SECONDS = int(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", str(24 * 60 * 60)))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "1000"))
+
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "llm_cache.sqlite3")
+LLM_CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", str(24 * 60 * 60)))
+
+# キャッシュ済みの応答もストリーミングと同じ見え方になるよう分割して返す
+CACHED_CHUNK_SIZE = 32
+
+# SingleFlight の受信タスクがストリームの終わりを伝える印
+_STREAM_END = object()
+
+
+def iter_chunks(text: str, size: int = CACHED_CHUNK_SIZE) -> Iterator[str]:
+    for start in range(0, len(text), size):
+        yield text[start:start + size]
+
+
+class ResponseCache:
+    """
+    (モデル, temperature, system, プロンプト) の完全一致で引く LLM 応答キャッシュ
+    SQLite に応答本文を zstd 圧縮して保存する。TTL が 0 のときは無効
+    """
+
+    def __init__(self, path: str = LLM_CACHE_PATH, ttl_seconds: int = LLM_CACHE_TTL_SECONDS):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._db: aiosqlite.Connection | None = None
+        self._lock = asyncio.Lock()
+        self._compressor = zstandard.ZstdCompressor()
+        self._decompressor = zstandard.ZstdDecompressor()
+
+    @staticmethod
+    def make_key(model_name: str, temperature: float | None, prompt: str, system: str | None = None) -> str:
+        return hashlib.sha256(f"{model_name}|{temperature}|{system or ''}|{prompt}".encode()).hexdigest()
+
+    async def get(self, key: str) -> str | None:
+        db = await self.__get_db()
+        async with db.execute(
+            "SELECT value FROM llm_responses WHERE key = ? AND expires_at > ?", (key, time.time())
+        ) as cur:
+            row = await cur.fetchone()
+        if not row:
+            return None
+        return self._decompressor.decompress(row[0]).decode()
+
+    async def set(self, key: str, response: str):
+        # プロンプトはキーで一意に決まるので、応答本文だけを保存する
+        value = self._compressor.compress(response.encode())
+        db = await self.__get_db()
+        await db.execute(
+            "INSERT OR REPLACE INTO llm_responses (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, value, time.time() + self.ttl_seconds),
+        )
+        await db.commit()
+
+    def cached(self, model_name: str, temperature: float | None = None):
+        """
+        ストリーミングする LLM 呼び出し関数（async generator）用のデコレーター
+        最後まで受信できた空でない応答だけを保存する
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(prompt: str, system: str | None = None):
+                if self.ttl_seconds <= 0:
+                    async for chunk in func(prompt, system):
+                        yield chunk
+                    return
+
+                key = self.make_key(model_name, temperature, prompt, system)
+                cached = await self.get(key)
+                if cached is not None:
+                    for chunk in iter_chunks(cached):
+                        yield chunk
+                    return
+
+                chunks = []
+                async for chunk in func(prompt, system):
+                    chunks.append(chunk)
+                    yield chunk
+
+                response = "".join(chunks)
+                if response:
+                    await self.set(key, response)
+            return wrapper
+        return decorator
+
+    async def close(self):
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+    async def __get_db(self) -> aiosqlite.Connection:
+        """
+        初回アクセス時に接続してテーブルを用意し、期限切れの行を掃除する
+        """
+        async with self._lock:
+            if self._db is None:
+                db = await aiosqlite.connect(self.path)
+                await db.execute(
+                    "CREATE TABLE IF NOT EXISTS llm_responses (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL)"
+                )
+                await db.execute("DELETE FROM llm_responses WHERE expires_at <= ?", (time.time(),))
+                await db.commit()
+                self._db = db
+            return self._db
+
+
+class SingleFlight:
+    """
+    同一キーの LLM 呼び出しが実行中なら、新たに API を呼ばずにその結果を待つクラス
+    キーは ResponseCache と同じ。イベントループは単一スレッドなのでロックは不要
+    """
+
+    def __init__(self):
+        self._inflight: dict[str, asyncio.Future[str]] = {}
+        # 実行中のタスクが GC されないよう参照を持っておく
+        self._tasks: set[asyncio.Task] = set()
+
+    def deduplicated(self, model_name: str, temperature: float | None = None):
+        """
+        ストリーミングする LLM 呼び出し関数（async generator）用のデコレーター
+        先行する呼び出しはそのままストリーミングし、後続の呼び出しは全文の完成を待って返す
+
+        プロバイダーからの受信は別タスクで行うため、先行する呼び出し側が途中で受信をやめても
+        最後まで受信して後続の呼び出しに結果を渡す
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(prompt: str, system: str | None = None):
+                key = ResponseCache.make_key(model_name, temperature, prompt, system)
+                inflight = self._inflight.get(key)
+                if inflight is not None:
+                    # 待機側がキャンセルされても先行する呼び出しの Future は残す
+                    response = await asyncio.shield(inflight)
+                    for chunk in iter_chunks(response):
+                        yield chunk
+                    return
+
+                future = asyncio.get_running_loop().create_future()
+                self._inflight[key] = future
+                queue: asyncio.Queue = asyncio.Queue()
+                task = asyncio.create_task(self.__fetch(key, func(prompt, system), queue, future))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+                while (chunk := await queue.get()) is not _STREAM_END:
+                    yield chunk
+                # 失敗していればここで例外を送出する
+                future.result()
+            return wrapper
+        return decorator
+
+    async def __fetch(self, key: str, stream, queue: asyncio.Queue, future: asyncio.Future[str]):
+        """
+        ストリームを最後まで受信し、差分を queue に流しながら全文を future に設定する
+        """
+        chunks = []
+        try:
+            async for chunk in stream:
+                chunks.append(chunk)
+                queue.put_nowait(chunk)
+            future.set_result("".join(chunks))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            self._inflight.pop(key, None)
+            if not future.done():
+                # シャットダウンなどでタスク自体がキャンセルされた場合
+                future.cancel()
+            elif not future.cancelled():
+                # 待機者がいなくても「例外が取得されていない」警告が出ないようにする
+                future.exception()
+            queue.put_nowait(_STREAM_END)
+
+
+class SemanticCache:
+    """
+    埋め込みの類似度で照合する LLM 応答キャッシュ
+    言い換えられた議題でも、類似度がしきい値を超えれば保存済みの応答を返す
+    """
+
+    def __init__(
+        self,
+        embedder: TextEmbedder,
+        threshold: float = SEMANTIC_CACHE_THRESHOLD,
+        ttl_seconds: int = SEMANTIC_CACHE_TTL_SECONDS,
+        max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES,
+    ):
+        self.embedder = embedder
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        # model_name -> [(埋め込み, 応答, 有効期限)]
+        self._entries: dict[str, list[tuple[np.ndarray, str, float]]] = {}
+
+    async def get(self, model_name: str, key_text: str, embedding: np.ndarray | None = None) -> str | None:
+        """
+        類似度がしきい値以上で最も近い応答を返す。なければ None
+        """
+        entries = self.__live_entries(model_name)
+        if not entries:
+            return None
+
+        if embedding is None:
+            embedding = await self.embedder.embed(key_text)
+        if embedding is None:
+            return None
+
+        scores = np.stack([vector for vector, _, _ in entries]) @ embedding
+        best = int(np.argmax(scores))
+        return entries[best][1] if scores[best] >= self.threshold else None
+
+    async def set(self, model_name: str, key_text: str, response: str, embedding: np.ndarray | None = None):
+        if embedding is None:
+            embedding = await self.embedder.embed(key_text)
+        if embedding is None:
+            return
+
+        entries = self.__live_entries(model_name)
+        entries.append((embedding, response, time.monotonic() + self.ttl_seconds))
+        del entries[:-self.max_entries]
+
+    def cached(self, model_name: str):
+        """
+        ストリーミングする LLM 呼び出し関数（async generator）用のデコレーター
+
+        呼び出し側が semantic_key を渡したときだけキャッシュを使う。
+        semantic_key はプロンプトを一意に決める部分（例: 議題そのもの）を渡すこと。
+        定型文ごと埋め込むと定型部分の類似度で別の議題が一致してしまうため。
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(prompt: str, *args, semantic_key: str | None = None, **kwargs):
+                if semantic_key is None:
+                    async for chunk in func(prompt, *args, **kwargs):
+                        yield chunk
+                    return
+
+                embedding = await self.embedder.embed(semantic_key)
+                cached = await self.get(model_name, semantic_key, embedding)
+                if cached is not None:
+                    for chunk in iter_chunks(cached):
+                        yield chunk
+                    return
+
+                chunks = []
+                async for chunk in func(prompt, *args, **kwargs):
+                    chunks.append(chunk)
+                    yield chunk
+
+                response = "".join(chunks)
+                if response:
+                    await self.set(model_name, semantic_key, response, embedding)
+            return wrapper
+        return decorator
+
+    def __live_entries(self, model_name: str) -> list[tuple[np.ndarray, str, float]]:
+        """
+        期限切れのエントリを除いたリストを返す
+        """
+        now = time.monotonic()
+        entries = [entry for entry in self._entries.get(model_name, []) if entry[2] > now]
+        self._entries[model_name] = entries
+        return entries
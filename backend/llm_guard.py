@@ -0,0 +1,163 @@
+import os
+import time
+import random
+import asyncio
+import functools
+from collections import deque
+from typing import Callable
+
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_BACKOFF_BASE_SECONDS = float(os.getenv("LLM_BACKOFF_BASE_SECONDS", "1.0"))
+LLM_BACKOFF_MAX_SECONDS = float(os.getenv("LLM_BACKOFF_MAX_SECONDS", "20.0"))
+
+CIRCUIT_FAILURE_RATE = float(os.getenv("CIRCUIT_FAILURE_RATE", "0.5"))
+CIRCUIT_WINDOW_SIZE = int(os.getenv("CIRCUIT_WINDOW_SIZE", "20"))
+CIRCUIT_MIN_CALLS = int(os.getenv("CIRCUIT_MIN_CALLS", "5"))
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", "30"))
+
+
+class CircuitOpenError(Exception):
+    """
+    サーキットブレーカーが OPEN のため、呼び出しを行わずに失敗させたことを表す例外
+    """
+
+
+class CircuitBreaker:
+    """
+    直近の呼び出しの失敗率を見て、プロバイダーへの呼び出しを一時的に止めるクラス
+
+    - CLOSED: 通常どおり呼び出す。失敗率がしきい値を超えたら OPEN にする
+    - OPEN: 一定時間は呼び出さずに即座に失敗させる。時間が経ったら HALF_OPEN にする
+    - HALF_OPEN: 試しに1件だけ呼び出し、成功なら CLOSED、失敗なら再び OPEN にする
+    """
+
+    CLOSED = "CLOSED"
+    OPEN = "OPEN"
+    HALF_OPEN = "HALF_OPEN"
+
+    def __init__(
+        self,
+        name: str,
+        failure_rate: float = CIRCUIT_FAILURE_RATE,
+        window_size: int = CIRCUIT_WINDOW_SIZE,
+        min_calls: int = CIRCUIT_MIN_CALLS,
+        open_seconds: float = CIRCUIT_OPEN_SECONDS,
+    ):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self.state = self.CLOSED
+        self._results: deque[bool] = deque(maxlen=window_size)  # True: 成功
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        # OPEN にするたびに進める世代。OPEN より前に始まった呼び出しの結果を無視するのに使う
+        self._generation = 0
+
+    def before_call(self) -> tuple[int, bool]:
+        """
+        呼び出してよいか判定する。止めている間は CircuitOpenError を送出する
+        呼び出しの結果を記録するときに渡す (世代, HALF_OPEN の試行か) を返す
+        """
+        if self.state == self.OPEN:
+            if time.monotonic() - self._opened_at < self.open_seconds:
+                raise CircuitOpenError(f"{self.name} への呼び出しを一時停止しています。しばらくしてから再試行してください")
+            self.state = self.HALF_OPEN
+
+        if self.state == self.HALF_OPEN:
+            if self._trial_in_flight:
+                raise CircuitOpenError(f"{self.name} の復旧を確認中です。しばらくしてから再試行してください")
+            self._trial_in_flight = True
+            return self._generation, True
+        return self._generation, False
+
+    def record_success(self, ticket: tuple[int, bool]):
+        generation, trial = ticket
+        if generation != self._generation:
+            return
+        if trial:
+            # HALF_OPEN を CLOSED に戻せるのは試行の呼び出しだけ
+            self.state = self.CLOSED
+            self._results.clear()
+            self._trial_in_flight = False
+        self._results.append(True)
+
+    def record_failure(self, ticket: tuple[int, bool]):
+        generation, trial = ticket
+        if generation != self._generation:
+            return
+        if trial:
+            self._trial_in_flight = False
+            self.__open()
+            return
+
+        self._results.append(False)
+        failures = self._results.count(False)
+        if len(self._results) >= self.min_calls and failures / len(self._results) > self.failure_rate:
+            self.__open()
+
+    def release(self, ticket: tuple[int, bool]):
+        """
+        結果を記録せずに呼び出しが終わった場合（受信の途中終了など）に試行枠を戻す
+        """
+        generation, trial = ticket
+        if trial and generation == self._generation:
+            self._trial_in_flight = False
+
+    def __open(self):
+        self.state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._results.clear()
+        self._generation += 1
+
+
+def backoff_seconds(attempt: int) -> float:
+    """
+    指数バックオフ + フルジッター
+    """
+    return random.uniform(0, min(LLM_BACKOFF_MAX_SECONDS, LLM_BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+def guarded(
+    breaker: CircuitBreaker,
+    semaphore: asyncio.Semaphore,
+    is_retryable: Callable[[Exception], bool],
+    max_retries: int = LLM_MAX_RETRIES,
+):
+    """
+    ストリーミングする LLM 呼び出し関数（async generator）用のデコレーター
+
+    同時実行数をセマフォで制限し、サーキットブレーカーを通して呼び出す。
+    一時的なエラー（is_retryable が True）は、まだ1チャンクも返していなければバックオフして再試行する。
+    ブレーカーには再試行を含めた1回の呼び出しにつき1件だけ結果を記録する（429 の再試行で OPEN にならないように）。
+    結果は呼び出しを始めたときの世代に対して記録するので、OPEN より前に始まった呼び出しは HALF_OPEN の判定に影響しない。
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            ticket = breaker.before_call()
+            try:
+                for attempt in range(max_retries + 1):
+                    received = False
+                    try:
+                        async with semaphore:
+                            async for chunk in func(*args, **kwargs):
+                                received = True
+                                yield chunk
+                    except Exception as e:
+                        if not is_retryable(e):
+                            # プロバイダーは応答しているので、障害としては数えない
+                            breaker.record_success(ticket)
+                            raise
+                        if received or attempt == max_retries:
+                            breaker.record_failure(ticket)
+                            raise
+                        await asyncio.sleep(backoff_seconds(attempt))
+                        continue
+
+                    breaker.record_success(ticket)
+                    return
+            finally:
+                breaker.release(ticket)
+        return wrapper
+    return decorator
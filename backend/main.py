@@ -1,16 +1,32 @@
 import os
+import asyncio
 import logging
 import random
-import json
+import orjson
+import threading
+from contextlib import aclosing, asynccontextmanager, suppress
+from string import Template
+from typing import AsyncIterator
+import httpx
+import ahocorasick
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.websockets import WebSocketState
 import requests
 from analyze_thumbnail import AnalyzeThumbnail
 
 import openai
+from openai import AsyncOpenAI
 from google import genai
+from google.genai import errors as genai_errors
+from google.genai import types
 
 from comment_analyzer import CommentAnalyzer
+from conversation import ConversationHistory
+from llm_cache import ResponseCache, SemanticCache, SingleFlight
+from llm_guard import CircuitBreaker, guarded
+from session_store import SessionStore
+from text_embedding import TextEmbedder, cosine_similarity
 from channel_subscriber_popular_analyzer import ChannelPopularityAnalyzer
 
 
@@ -22,49 +38,285 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
 
 GPT_MODEL_NAME = "chatgpt-4o-latest"
 GEMINI_MODEL_NAME = "gemini-2.0-flash"
+GPT_TEMPERATURE = 0.7
 
-openai.api_key = OPENAI_API_KEY
+# プロバイダーごとの同時リクエスト数の上限
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "32"))
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "32"))
+
+# 連続する2発言の類似度がこの値を超えたら、主張が収束したとみなして終了確認を省いて議論を終える
+# （合意の語の有無は問わない。既定値は控えめにしているので、実際の議論ログで類似度の分布を見て調整すること）
+CONVERGENCE_THRESHOLD = float(os.getenv("CONVERGENCE_THRESHOLD", "0.95"))
+
+# コメントデータをプロンプトに埋め込むときのトークン数の上限（コンテキスト長を超えないよう末尾を切り詰める）
+COMMENT_DATA_MAX_TOKENS = int(os.getenv("COMMENT_DATA_MAX_TOKENS", "60000"))
+# tiktoken のエンコーディングが読み込めない環境では、代わりに文字数で切り詰める
+COMMENT_DATA_MAX_CHARS = int(os.getenv("COMMENT_DATA_MAX_CHARS", "60000"))
+
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
+logger = logging.getLogger("websocket_server")
+
+# ===============================
+# HTTP コネクションプール
+# ===============================
+# プロセス全体で keep-alive / HTTP/2 のコネクションを使い回し、
+# 発言ごとの TCP + TLS ハンドシェイクを避ける（OpenAI / Gemini とも同じプールを共有する）
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=64, max_connections=128)
+HTTP_TIMEOUT = 60
+
+http_client = httpx.AsyncClient(http2=True, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+openai_client = None
+try:
+    # 再試行は llm_guard 側でまとめて行うため、SDK 自体の再試行は無効にする
+    openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=http_client, max_retries=0)
+except Exception as e:
+    logger.error("OpenAIの初期化エラー: %s", e)
 
 client = None
 try:
-    client = genai.Client(api_key=GEMINI_API_KEY)
+    client = genai.Client(
+        api_key=GEMINI_API_KEY,
+        http_options=types.HttpOptions(httpx_async_client=http_client),
+    )
 except Exception as e:
-    print(f"Geminiの初期化エラー: {e}")
+    logger.error("Geminiの初期化エラー: %s", e)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 初回はエンコーディングのダウンロードが走るため、起動を待たせずに別スレッドで読み込む
+    threading.Thread(target=load_token_encoding, daemon=True).start()
+    yield
+    # シャットダウン時にコネクションプールとキャッシュを閉じる
+    await http_client.aclose()
+    await response_cache.close()
+    await session_store.close()
 
-app = FastAPI()
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger("websocket_server")
+
+app = FastAPI(lifespan=lifespan)
+
+
+# ===============================
+# 応答キャッシュ
+# ===============================
+text_embedder = TextEmbedder()
+semantic_cache = SemanticCache(text_embedder)
+response_cache = ResponseCache()
+single_flight = SingleFlight()
+session_store = SessionStore()
+
+
+# ===============================
+# 同時実行数の制御 / サーキットブレーカー
+# ===============================
+# 同時接続が増えても各プロバイダーへの同時リクエストを上限内に抑え、
+# 共有コネクションプール上で公平に多重化する（キャッシュヒット時は枠を使わない）
+openai_semaphore = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+gemini_semaphore = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+
+openai_breaker = CircuitBreaker("ChatGPT")
+gemini_breaker = CircuitBreaker("Gemini")
+
+
+def is_retryable_openai_error(e: Exception) -> bool:
+    return isinstance(e, (
+        openai.RateLimitError,
+        openai.APITimeoutError,
+        openai.APIConnectionError,
+        openai.InternalServerError,
+        httpx.TimeoutException,
+    ))
+
+
+def is_retryable_gemini_error(e: Exception) -> bool:
+    if isinstance(e, genai_errors.ServerError):
+        return True
+    if isinstance(e, genai_errors.ClientError):
+        return e.code == 429
+    return isinstance(e, (httpx.TimeoutException, httpx.TransportError))
 
 
 # ===============================
 # GPT 呼び出し関数
 # ===============================
-def call_chatgpt(prompt: str) -> str:
-    try:
-        response = openai.chat.completions.create(
-            model=GPT_MODEL_NAME,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.7,
-        )
-        return response.choices[0].message.content if response.choices else "エラー: GPT からのレスポンスがありません"
-    except Exception as e:
-        return f"ChatGPTエラー: {e}"
+@semantic_cache.cached(GPT_MODEL_NAME)
+@response_cache.cached(GPT_MODEL_NAME, GPT_TEMPERATURE)
+@single_flight.deduplicated(GPT_MODEL_NAME, GPT_TEMPERATURE)
+@guarded(openai_breaker, openai_semaphore, is_retryable_openai_error)
+async def _stream_chatgpt(prompt: str, system: str | None = None) -> AsyncIterator[str]:
+    # system（分析データや固定の指示）は先頭に渡す。1024 トークン以上の共通プレフィックスはプロバイダー側でキャッシュされる
+    messages = [{"role": "system", "content": system}] if system else []
+    messages.append({"role": "user", "content": prompt})
+    stream = await openai_client.chat.completions.create(
+        model=GPT_MODEL_NAME,
+        messages=messages,
+        temperature=GPT_TEMPERATURE,
+        stream=True,
+    )
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+async def call_chatgpt(prompt: str, system: str | None = None, semantic_key: str | None = None) -> AsyncIterator[str]:
+    """
+    エラーは発言として扱わないよう、文字列にせずそのまま呼び出し側に送出する
+    """
+    if not openai_client:
+        raise RuntimeError("OpenAI の Client が初期化されていません")
+    received = False
+    async for delta in _stream_chatgpt(prompt, system, semantic_key=semantic_key):
+        received = True
+        yield delta
+    if not received:
+        raise RuntimeError("GPT からのレスポンスがありません")
 
 
 # ===============================
 # Gemini 呼び出し関数
 # ===============================
-def call_gemini(prompt: str) -> str:
+@semantic_cache.cached(GEMINI_MODEL_NAME)
+@response_cache.cached(GEMINI_MODEL_NAME)
+@single_flight.deduplicated(GEMINI_MODEL_NAME)
+@guarded(gemini_breaker, gemini_semaphore, is_retryable_gemini_error)
+async def _stream_gemini(prompt: str, system: str | None = None) -> AsyncIterator[str]:
+    stream = await client.aio.models.generate_content_stream(
+        model=GEMINI_MODEL_NAME,
+        contents=prompt,
+        config=types.GenerateContentConfig(system_instruction=system) if system else None,
+    )
+    async for chunk in stream:
+        if chunk.text:
+            yield chunk.text
+
+
+async def call_gemini(prompt: str, system: str | None = None, semantic_key: str | None = None) -> AsyncIterator[str]:
+    """
+    エラーは発言として扱わないよう、文字列にせずそのまま呼び出し側に送出する
+    """
     if not client:
-        return "Gemini の Client が初期化されていません"
-    try:
-        response = client.models.generate_content(
-            model=GEMINI_MODEL_NAME,
-            contents=prompt,
-        )
-        return response.text if response.text else "エラー: Gemini からのレスポンスがありません"
-    except Exception as e:
-        return f"Geminiエラー: {e}"
+        raise RuntimeError("Gemini の Client が初期化されていません")
+    received = False
+    async for delta in _stream_gemini(prompt, system, semantic_key=semantic_key):
+        received = True
+        yield delta
+    if not received:
+        raise RuntimeError("Gemini からのレスポンスがありません")
+
+
+# ===============================
+# WebSocket 送信 / ストリーミング補助
+# ===============================
+async def send_json(websocket: WebSocket, payload: dict):
+    """
+    orjson で直接 bytes にシリアライズし、バイナリフレームで送信する
+    """
+    await websocket.send_bytes(orjson.dumps(payload))
+
+
+async def receive_json(websocket: WebSocket):
+    """
+    受信したフレームを str にデコードせず、そのまま orjson でパースする
+    （互換のためテキストフレームも受け付ける）
+    """
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    raw = message.get("bytes")
+    return orjson.loads(raw if raw is not None else message["text"])
+
+
+async def collect_text(chunks: AsyncIterator[str]) -> str:
+    """
+    ストリームを最後まで受信して全文を返す
+    """
+    async with aclosing(chunks):
+        return "".join([chunk async for chunk in chunks])
+
+
+async def stream_to_client(websocket: WebSocket, sender: str, chunks: AsyncIterator[str]) -> str:
+    """
+    受信した差分を {"sender", "delta"} で逐次送信し、最後に {"sender", "text", "done"} で全文を確定させる
+    """
+    parts = []
+    # 送信に失敗しても受信元をすぐ閉じ、セマフォの枠や実行中の呼び出しを GC 任せにしない
+    async with aclosing(chunks):
+        async for chunk in chunks:
+            parts.append(chunk)
+            await send_json(websocket, {"sender": sender, "delta": chunk})
+    text = "".join(parts)
+    await send_json(websocket, {"sender": sender, "text": text, "done": True})
+    return text
+
+
+# ===============================
+# プロンプト
+# ===============================
+# 固定の指示文は毎ターン同一のバイト列にしておき、相手の発言や回数などの可変部分は末尾に置く
+# （プロバイダーのプレフィックスキャッシュは 1024 トークン以上が対象のため、効くのは分析データを先頭に置く初見とまとめ）
+DEBATE_INSTRUCTIONS = """あなたは2つの生成AIによる議論に参加しています。相手の意見に対して、以下に従って発言してください。
+
+1. 論理的な矛盾があるか確認し、あれば明確に指摘してください。
+2. 必要であれば補足説明を加えてください。
+3. 議論を続けるべきか、合意して終了するべきかを判断してください。ただし、論理的な矛盾がない、かつ、どうしても述べたいことがなければ、議論を終了してください。
+4. 発言回数には上限があります。議論を続けるのは構いませんが発言回数を意識して収束するようにしてください
+
+1000文字以内でお願いします。"""
+
+CONFIRM_END_INSTRUCTIONS = """あなたは2つの生成AIによる議論に参加しています。
+これまでの議論とあなたの最新の発言を踏まえて、議論は終了してもよいですか？「はい」または「いいえ」で答えてください。"""
+
+SUMMARY_INSTRUCTIONS = """これまでの議論を以下のフォーマットでまとめてください：
+1. 【議題】
+2. 【主張と意見】
+3. 【合意点 / 食い違い点】
+4. 【結論と今後の方向性】
+
+ただし、マークダウンで出力できるようにフォーマットをしてください。"""
+
+COMMENT_SUMMARY_INSTRUCTIONS = """これまでの議論の内容、および提供したデータから、最終的な当該動画のコメント分析結果を詳細にまとめてください。
+客先に提出する内容なので、このレポートを見て動画の振り返りや今後の企画ができるような内容に仕上げてください。
+コメントから見える動画内容への評価や、視聴者の反応についても含めてください。
+年齢分布予測や性別分布予測などのデモグラフィックデータはチャンネルに対してで動画やコメントから推定した値ではないので注意してください。
+コメントの書き方などからコメントのポジティブ度、ネガティブ度、性別予測などを割合で出してほしいです。
+データを混同したくないので、あなたが自身が推定したものについては、GPTによる推定と明記してください。
+
+また、各生成AIの解釈や認識に違いがあった場合は、別途項目を作り、それぞれ、どのような違いがあったのかをまとめてください。
+ただし、マークダウンで出力できるようにフォーマットをしてください。"""
+
+# 可変部分のテンプレート（起動時に1度だけ構築）
+FIRST_VIEW_TEMPLATE = Template("'$prompt' に対して建設的な初見を述べてください。補足や提案を含め、1000文字以内で。")
+
+ATTACKER_TEMPLATE = Template("""あなたは $attacker として議論に参加しています。
+相手($defender)の意見:
+$last
+
+あなたの発言回数は $count 回目です。上限は $max_comments 回です。""")
+
+CONFIRM_END_TEMPLATE = Template("""これまでの議論:
+$recent
+
+あなたの最新の発言:
+$latest""")
+
+SUMMARY_TEMPLATE = Template("""これまでの議論:
+$conversation""")
+
+
+# ===============================
+# 合意判定
+# ===============================
+# 合意を示す語を1回の走査でまとめて検出するオートマトン（起動時に1度だけ構築）
+AGREEMENT_MARKERS = ("合意", "同意", "賛成", "納得")
+
+agreement_automaton = ahocorasick.Automaton()
+for marker in AGREEMENT_MARKERS:
+    agreement_automaton.add_word(marker, marker)
+agreement_automaton.make_automaton()
+
+
+def contains_agreement(text: str) -> bool:
+    return any(True for _ in agreement_automaton.iter(text))
 
 
 @app.websocket("/ws")
@@ -72,216 +324,356 @@ async def websocket_endpoint(websocket: WebSocket):
     """
     - 両者が最低3回は話す
     - 各モデル最大10回 (合計20発言) になったら強制終了
-    - それまでに"合意" or "同意" が出ても、両者とも3回以上話していなければ続行
+    - 両者とも3回以上話したら、毎ターン発言者に終了してよいか確認する
+    - ただし、相手の直前の発言と埋め込みの類似度が CONVERGENCE_THRESHOLD を超えたら、合意の語がなくても確認せずに終了する
+    - 続けて2発言とも合意を示す語（合意・同意・賛成・納得）を含む場合は、確認せずに終了する
     - 追加データがある場合は、プロンプトに埋め込んで AI に渡す
+
+    - sessionId を渡すと発言ごとに途中経過を保存し、切断後に同じ sessionId で再接続すると続きから再開する
+
+    クライアントは最初のリクエスト JSON を UTF-8 のバイナリフレームで送信する（テキストフレームも可）。
+    サーバーからの送信はすべて JSON のバイナリフレーム。議論が最後まで終わると {"sender": "system", "end": true} を送る。
+    処理を続けられないエラーのときも、エラー内容を text に入れて end を送る（クライアントは再開を試みない）。
     """
     await websocket.accept()
     logger.info("クライアントが接続されました")
 
+    session_id = None
     try:
-        conversation_history = []  # (sender, text)
-        input_data = await websocket.receive_text()
-        input_json = json.loads(input_data)
+        input_json = await receive_json(websocket)
 
         topic = input_json.get("topic", "")
         analysis_type = input_json.get("analysisType", "none")
         video_id = input_json.get("videoId")
         channel_id = input_json.get("channelId")
+        session_id = input_json.get("sessionId")
 
-        conversation_history.append(("User", topic))
+        # **中断されたセッションの復元**（議題が変わっていれば新しい議論として扱う）
+        checkpoint = await session_store.load(session_id) if session_id else None
+        if checkpoint and checkpoint["topic"] != topic:
+            checkpoint = None
+
+        if checkpoint:
+            conversation_history = ConversationHistory.from_entries(checkpoint["history"])
+            await send_json(websocket, {"sender": "system", "text": "中断された議論を再開します"})
+        else:
+            conversation_history = ConversationHistory()
+            conversation_history.append("User", topic)
+
+        async def save_checkpoint(finished: bool = False):
+            """
+            発言ごとに途中経過を保存する（再開時はここから続ける）
+            """
+            if not session_id:
+                return
+            await session_store.save(session_id, {
+                "topic": topic,
+                "history": conversation_history.entries,
+                "gpt_count": gpt_count,
+                "gem_count": gem_count,
+                "attacker": attacker,
+                "defender": defender,
+                "finished": finished,
+            })
 
         # **分析データの取得**
-        analysis_data = load_data_for_analysis(analysis_type, video_id, channel_id)
+        analysis_data = await load_data_for_analysis(analysis_type, video_id, channel_id)
 
         # **プロンプト作成**
+        # 分析データは初見とまとめの system の先頭に同じバイト列で置き、プレフィックスキャッシュを効かせる
+        analysis_context = None
         if analysis_type == "comment_analysis":
-            prompt = __generate_comment_analysis_prompt(topic, analysis_data)
+            analysis_data = await asyncio.to_thread(__fit_comment_data, analysis_data)
+            analysis_context = __format_comment_analysis_data(analysis_data)
+            prompt = __generate_comment_analysis_prompt(topic)
         elif analysis_type == "channel_subscriber_popular_channel":
-            prompt = __generate_popular_channels_prompt(topic, analysis_data)
+            analysis_context = __format_popular_channels_data(analysis_data)
+            prompt = __generate_popular_channels_prompt(topic)
         else:
             prompt = topic  # そのまま議題を使用
 
-        # **(1) GPT / Gemini 初期見解**
-        try:
-            gpt_first = call_chatgpt(
-                f"'{prompt}' に対して建設的な初見を述べてください。補足や提案を含め、1000文字以内で。"
-            )
-        except Exception as e:
-            await websocket.send_text(json.dumps({"sender": "system", "text": f"ChatGPTエラー: {e}"}))
-            return
+        if checkpoint:
+            gpt_count = checkpoint["gpt_count"]
+            gem_count = checkpoint["gem_count"]
+            attacker = checkpoint["attacker"]
+            defender = checkpoint["defender"]
+            finished = checkpoint["finished"]
+        else:
+            # **(1) GPT / Gemini 初期見解** (両モデルへの問い合わせを並列に実行)
+            first_prompt = FIRST_VIEW_TEMPLATE.safe_substitute(prompt=prompt)
+            # 議題だけのプロンプトは言い換えも含めてキャッシュを引く（分析データ付きは対象外）
+            semantic_key = topic if prompt == topic else None
+            # GPT の発言をストリーミングしている間に、Gemini の発言をバックグラウンドで受信しておく
+            # どちらかが失敗したら議論を始めずに終了する（エラーは末尾の except でクライアントに通知する）
+            gemini_task = asyncio.create_task(collect_text(call_gemini(first_prompt, analysis_context, semantic_key=semantic_key)))
+            try:
+                gpt_first = await stream_to_client(
+                    websocket, f"GPT:{GPT_MODEL_NAME}", call_chatgpt(first_prompt, analysis_context, semantic_key=semantic_key)
+                )
+                gemini_first = await gemini_task
+            finally:
+                gemini_task.cancel()
 
-        try:
-            gemini_first = call_gemini(
-                f"'{prompt}' に対して建設的な初見を述べてください。補足や提案を含め、1000文字以内で。"
-            )
-        except Exception as e:
-            await websocket.send_text(json.dumps({"sender": "system", "text": f"Geminiエラー: {e}"}))
-            return
+            # **初期発言を送信 & 履歴保存**
+            conversation_history.append(f"GPT:{GPT_MODEL_NAME}", gpt_first)
 
-        # **初期発言を送信 & 履歴保存**
-        await websocket.send_text(json.dumps({"sender": f"GPT:{GPT_MODEL_NAME}", "text": gpt_first}))
-        conversation_history.append((f"GPT:{GPT_MODEL_NAME}", gpt_first))
+            await send_json(websocket, {"sender": f"Gemini:{GEMINI_MODEL_NAME}", "text": gemini_first, "done": True})
+            conversation_history.append(f"Gemini:{GEMINI_MODEL_NAME}", gemini_first)
 
-        await websocket.send_text(json.dumps({"sender": f"Gemini:{GEMINI_MODEL_NAME}", "text": gemini_first}))
-        conversation_history.append((f"Gemini:{GEMINI_MODEL_NAME}", gemini_first))
+            # **(2) 議論の進行**
+            roles = [f"GPT:{GPT_MODEL_NAME}", f"Gemini:{GEMINI_MODEL_NAME}"]
+            random.shuffle(roles)
+            attacker, defender = roles
 
-        # **(2) 議論の進行**
-        roles = [f"GPT:{GPT_MODEL_NAME}", f"Gemini:{GEMINI_MODEL_NAME}"]
-        random.shuffle(roles)
-        attacker, defender = roles
+            gpt_count = 1
+            gem_count = 1
+            finished = False
+            await save_checkpoint()
 
-        gpt_count = 1
-        gem_count = 1
         max_comments = 10  # 各AIの最大発言回数
-
-        while gpt_count < max_comments and gem_count < max_comments:
-            attacker_prompt = f"""
-            あなたは {attacker} として議論に参加しています。
-            相手({defender})の意見:
-            {conversation_history[-1][1]}
-
-            1. 論理的な矛盾があるか確認し、あれば明確に指摘してください。
-            2. 必要であれば補足説明を加えてください。
-            3. 議論を続けるべきか、合意して終了するべきかを判断してください。ただし、論理的な矛盾がない、かつ、どうしても述べたいことがなければ、議論を終了してください。
-            4. 発言回数には上限があります。議論を続けるのは構いませんが発言回数を意識して収束するようにしてください
-
-            1000文字以内でお願いします。
-            あなたの発言回数は {gpt_count if "GPT" in attacker else gem_count} 回目です。上限は {max_comments} 回です。
-            """
+        defender_embedding = None  # 相手の直前の発言の埋め込み（前のターンで計算済みなら使い回す）
+
+        while not finished and gpt_count < max_comments and gem_count < max_comments:
+            defender_resp = conversation_history.last_text
+            attacker_prompt = ATTACKER_TEMPLATE.safe_substitute(
+                attacker=attacker,
+                defender=defender,
+                last=defender_resp,
+                count=gpt_count if "GPT" in attacker else gem_count,
+                max_comments=max_comments,
+            )
 
             try:
                 if "GPT" in attacker:
-                    attacker_resp = call_chatgpt(attacker_prompt)
+                    attacker_resp = await stream_to_client(
+                        websocket, attacker, call_chatgpt(attacker_prompt, DEBATE_INSTRUCTIONS)
+                    )
                     gpt_count += 1
                 else:
-                    attacker_resp = call_gemini(attacker_prompt)
+                    attacker_resp = await stream_to_client(
+                        websocket, attacker, call_gemini(attacker_prompt, DEBATE_INSTRUCTIONS)
+                    )
                     gem_count += 1
+            except WebSocketDisconnect:
+                raise
             except Exception as e:
-                await websocket.send_text(json.dumps({"sender": "system", "text": f"{attacker}エラー: {e}"}))
+                await send_json(websocket, {"sender": "system", "text": f"{attacker}エラー: {e}"})
                 break
 
-            conversation_history.append((attacker, attacker_resp))
-            await websocket.send_text(json.dumps({"sender": attacker, "text": attacker_resp}))
+            conversation_history.append(attacker, attacker_resp)
 
             # **最低3回話すまでは終了判定を行わない**
-            if gpt_count >= 3 and gem_count >= 3:
-                confirm_end_prompt = f"""
-                これまでの議論:
-                {conversation_history[-5:]}
+            if min(gpt_count, gem_count) >= 3:
+                # 相手の直前の発言とほぼ同じ内容になったら、合意の語がなくても確認せずに終了する
+                attacker_embedding = await text_embedder.embed(attacker_resp)
+                if defender_embedding is None:
+                    defender_embedding = await text_embedder.embed(defender_resp)
+                if (
+                    attacker_embedding is not None
+                    and defender_embedding is not None
+                    and cosine_similarity(attacker_embedding, defender_embedding) > CONVERGENCE_THRESHOLD
+                ):
+                    break
+                # 次のターンでは今回の発言が「相手の直前の発言」になる
+                defender_embedding = attacker_embedding
 
-                あなたの最新の発言:
-                {attacker_resp}
+                # 双方が続けて合意を示す語を使っていれば、確認の呼び出しを省いて終了する
+                if contains_agreement(attacker_resp) and contains_agreement(defender_resp):
+                    break
 
-                議論は終了してもよいですか？「はい」または「いいえ」で答えてください。
-                """
-                confirm_end_response = call_chatgpt(confirm_end_prompt) if "GPT" in attacker else call_gemini(confirm_end_prompt)
+                # それ以外は毎ターン、発言者に終了してよいか確認する
+                confirm_end_prompt = CONFIRM_END_TEMPLATE.safe_substitute(
+                    recent=conversation_history.joined(last=5), latest=attacker_resp
+                )
+                call_attacker = call_chatgpt if "GPT" in attacker else call_gemini
+                try:
+                    confirm_end_response = await collect_text(call_attacker(confirm_end_prompt, CONFIRM_END_INSTRUCTIONS))
+                except Exception as e:
+                    await send_json(websocket, {"sender": "system", "text": f"{attacker}エラー: {e}"})
+                    break
 
                 if "はい" in confirm_end_response:
                     break
 
             # 交代
             attacker, defender = defender, attacker
+            await save_checkpoint()
+
+        # 再接続時はまとめから再開する
+        await save_checkpoint(finished=True)
 
         # **(3) まとめ**
-        conversation_text = "\n\n".join([f"{speaker}: {text}" for speaker, text in conversation_history])
+        conversation_text = conversation_history.joined()
 
         if analysis_type == "none":
-            summary_prompt = f"""
-            これまでの議論:
-            {conversation_text}
-
-            以下のフォーマットでまとめてください：
-            1. 【議題】
-            2. 【主張と意見】
-            3. 【合意点 / 食い違い点】
-            4. 【結論と今後の方向性】
-
-            ただし、マークダウンで出力できるようにフォーマットをしてください。
-            """
+            summary_prompt = SUMMARY_TEMPLATE.safe_substitute(conversation=conversation_text)
             try:
-                summary = call_chatgpt(summary_prompt)
-                await websocket.send_text(json.dumps({"sender": "GPTまとめ", "text": summary}))
+                await stream_to_client(websocket, "GPTまとめ", call_chatgpt(summary_prompt, SUMMARY_INSTRUCTIONS))
+            except WebSocketDisconnect:
+                raise
             except Exception as e:
-                await websocket.send_text(json.dumps({"sender": "system", "text": f"まとめエラー: {e}"}))
+                await send_json(websocket, {"sender": "system", "text": f"まとめエラー: {e}"})
 
         if analysis_type == "comment_analysis":
-            summary_prompt = f"""
-            これまでの議論の内容、および提供したデータから、最終的な当該動画のコメント分析結果を詳細にまとめてください。
-            客先に提出する内容なので、このレポートを見て動画の振り返りや今後の企画ができるような内容に仕上げてください。
-            コメントから見える動画内容への評価や、視聴者の反応についても含めてください。
-            年齢分布予測や性別分布予測などのデモグラフィックデータはチャンネルに対してで動画やコメントから推定した値ではないので注意してください。
-            コメントの書き方などからコメントのポジティブ度、ネガティブ度、性別予測などを割合で出してほしいです。
-            データを混同したくないので、あなたが自身が推定したものについては、GPTによる推定と明記してください。
-
-            議論データ:
-            {conversation_text}
-
-            分析データ:
-            {analysis_data}
-
-            また、各生成AIの解釈や認識に違いがあった場合は、別途項目を作り、それぞれ、どのような違いがあったのかをまとめてください。
-            ただし、マークダウンで出力できるようにフォーマットをしてください。
-            """
+            summary_prompt = SUMMARY_TEMPLATE.safe_substitute(conversation=conversation_text)
+            summary_system = f"{analysis_context}\n\n{COMMENT_SUMMARY_INSTRUCTIONS}"
             try:
-                summary = call_chatgpt(summary_prompt)
-                await websocket.send_text(json.dumps({"sender": "GPTまとめ", "text": summary}))
+                await stream_to_client(websocket, "GPTまとめ", call_chatgpt(summary_prompt, summary_system))
+            except WebSocketDisconnect:
+                raise
             except Exception as e:
-                await websocket.send_text(json.dumps({"sender": "system", "text": f"まとめエラー: {e}"}))
+                await send_json(websocket, {"sender": "system", "text": f"まとめエラー: {e}"})
+
+        if session_id:
+            await session_store.delete(session_id)
+        await send_json(websocket, {"sender": "system", "end": True})
 
     except WebSocketDisconnect:
         logger.warning("クライアントが切断されました")
     except Exception as e:
-        logger.error(f"サーバーエラー: {e}")
+        logger.error("サーバーエラー: %s", e)
+        # 再接続しても同じエラーになるため、チェックポイントを破棄して議論の終了を通知する
+        # （送信側が切断済みなら切断によるエラーなので、再開できるようチェックポイントは残す）
+        if websocket.application_state == WebSocketState.CONNECTED:
+            if session_id:
+                with suppress(Exception):
+                    await session_store.delete(session_id)
+            with suppress(Exception):
+                await send_json(websocket, {"sender": "system", "text": f"サーバーエラー: {e}", "end": True})
     finally:
-        await websocket.close()
+        # 異常切断時は close も失敗するので、接続が残っているときだけ閉じる
+        if websocket.application_state == WebSocketState.CONNECTED:
+            with suppress(Exception):
+                await websocket.close()
         logger.info("WebSocketコネクション終了")
 
 
-def load_data_for_analysis(analysis_type: str, video_id: str = None, channel_id: str = None):
+# DBClient は固定のローカルポートで SSH トンネルを張るため、データ取得は同時に1件ずつ行う
+analysis_data_lock = asyncio.Lock()
+
+
+async def load_data_for_analysis(analysis_type: str, video_id: str = None, channel_id: str = None):
+    """
+    DB / S3 へのアクセスは同期処理なので、イベントループを止めないようスレッドで実行する
+    """
     if analysis_type == "comment_analysis" and video_id:
-        data = CommentAnalyzer(video_id).create_data()
-        print(f"data: {data}")
+        async with analysis_data_lock:
+            data = await asyncio.to_thread(lambda: CommentAnalyzer(video_id).create_data())
+        logger.debug("data: %s", data)
         return data
 
     if analysis_type == "channel_subscriber_popular_channel" and channel_id:
-        data = ChannelPopularityAnalyzer(channel_id).create_data()
-        print(f"data: {data}")
+        async with analysis_data_lock:
+            data = await asyncio.to_thread(lambda: ChannelPopularityAnalyzer(channel_id).create_data())
+        logger.debug("data: %s", data)
         return data
 
     return {"message": "データなし"}
 
-def __generate_comment_analysis_prompt(user_input: str, analysis_data: dict) -> str:
+def to_prompt_text(value) -> str:
+    """
+    プロンプトに埋め込む値を文字列にする
+    文字列（CSV など）はそのまま、それ以外は余分な空白のない JSON にしてトークン数を抑える
+    """
+    if isinstance(value, str):
+        return value
+    return orjson.dumps(value, default=str).decode()
+
+
+# 起動時に load_token_encoding で読み込む（読み込めなければ None のまま）
+token_encoding = None
+
+
+def load_token_encoding():
+    """
+    tiktoken のエンコーディングを読み込む（失敗してもログを出すだけで、文字数での切り詰めに切り替える）
+    """
+    global token_encoding
+    try:
+        import tiktoken
+        token_encoding = tiktoken.encoding_for_model("gpt-4o")
+    except Exception as e:
+        logger.warning("tiktoken のエンコーディングの読み込みに失敗しました: %s", e)
+
+
+def __fit_comment_data(analysis_data: dict) -> dict:
+    """
+    コメントデータが COMMENT_DATA_MAX_TOKENS を超える場合は、上限までで切り詰めたコピーを返す
+    エンコーディングが使えないときは COMMENT_DATA_MAX_CHARS 文字で切り詰める（CPU 処理なのでスレッドで呼ぶこと）
+    """
+    comment_data = analysis_data.get("comment_data")
+    if not isinstance(comment_data, str):
+        return analysis_data
+
+    encoding = token_encoding
+    if encoding is None:
+        if len(comment_data) <= COMMENT_DATA_MAX_CHARS:
+            return analysis_data
+        logger.warning("コメントデータを %d 文字から %d 文字に切り詰めました", len(comment_data), COMMENT_DATA_MAX_CHARS)
+        return {**analysis_data, "comment_data": comment_data[:COMMENT_DATA_MAX_CHARS]}
+
+    tokens = encoding.encode(comment_data)
+    if len(tokens) <= COMMENT_DATA_MAX_TOKENS:
+        return analysis_data
+
+    logger.warning("コメントデータを %d トークンから %d トークンに切り詰めました", len(tokens), COMMENT_DATA_MAX_TOKENS)
+    return {**analysis_data, "comment_data": encoding.decode(tokens[:COMMENT_DATA_MAX_TOKENS])}
+
+
+def __format_comment_analysis_data(analysis_data: dict) -> str:
+    """
+    `load_data_for_analysis` から取得したデータをプロンプトに埋め込む文字列にする
+    """
+    sections = [
+        "この動画の投稿日から7日間のコメントデータがあります。\n",
+        f"動画データ: {to_prompt_text(analysis_data['video_data'])}\n",
+        f"コメントデータ:\n{analysis_data['comment_data']}...\n\n",
+        f"動画の10日間の統計データ: {to_prompt_text(analysis_data['video_stats'])}\n",
+    ]
+    if analysis_data.get("other_sponsored_video_data"):
+        sections.append(f"スポンサード動画のデータ: {to_prompt_text(analysis_data['other_sponsored_video_data'])}\n")
+    if analysis_data.get("その他のスポンサード動画のコメントデータ"):
+        sections.append(f"スポンサード動画のコメントデータ: {to_prompt_text(analysis_data['other_sponsored_video_comments'])}\n")
+    sections += [
+        f"チャンネルデータ: {to_prompt_text(analysis_data['channel_data'])}\n",
+        f"チャンネルの視聴者層の年齢分布予測データ: {to_prompt_text(analysis_data['age_prediction'])}\n",
+        f"チャンネルの視聴者層の性別分布予測データ: {to_prompt_text(analysis_data['gender_prediction'])}\n",
+    ]
+    # 文字列の += を繰り返すと大きなコメントデータが毎回コピーされるため、最後に1度だけ結合する
+    return "".join(sections)
+
+
+def __generate_comment_analysis_prompt(user_input: str) -> str:
     """
-    ユーザーの議題と `load_data_for_analysis` から取得したデータを組み合わせてプロンプトを生成
+    ユーザーの議題から、分析データ（system 側）に対する指示のプロンプトを生成
     """
-    prompt = f"議題: '{user_input}'\n\n"
-
-    prompt += "この動画の投稿日から7日間のコメントデータがあります。\n"
-    prompt += f"動画データ: {analysis_data['video_data']}\n"
-    prompt += f"コメントデータ:\n{analysis_data['comment_data']}...\n\n"
-    prompt += f"動画の10日間の統計データ: {analysis_data['video_stats']}\n"
-    prompt += f"スポンサード動画のデータ: {analysis_data['other_sponsored_video_data']}\n" if analysis_data.get("other_sponsored_video_data") else ""
-    prompt += f"スポンサード動画のコメントデータ: {analysis_data['other_sponsored_video_comments']}\n" if analysis_data.get("その他のスポンサード動画のコメントデータ") else ""
-    prompt += f"チャンネルデータ: {analysis_data['channel_data']}\n"
-    prompt += f"チャンネルの視聴者層の年齢分布予測データ: {analysis_data['age_prediction']}\n"
-    prompt += f"チャンネルの視聴者層の性別分布予測データ: {analysis_data['gender_prediction']}\n"
-    prompt += "これらのデータから、この動画の分析を詳細に報告してください。マークダウンで出力できるようにフォーマットをしてください。"
-    prompt += "また、動画投稿日前後に起きた日本国内での出来事などと、可能であれば関連付けて分析してください。"
-    return prompt
-
-def __generate_popular_channels_prompt(user_input: str, analysis_data: dict) -> str:
+    return "".join([
+        f"議題: '{user_input}'\n\n",
+        "これらのデータから、この動画の分析を詳細に報告してください。マークダウンで出力できるようにフォーマットをしてください。",
+        "また、動画投稿日前後に起きた日本国内での出来事などと、可能であれば関連付けて分析してください。",
+    ])
+
+def __format_popular_channels_data(analysis_data: dict) -> str:
     """
-    ユーザーの議題と `load_data_for_analysis` から取得したデータを組み合わせてプロンプトを生成
+    `load_data_for_analysis` から取得したデータをプロンプトに埋め込む文字列にする
     """
-    prompt = f"議題: '{user_input}'\n\n"
+    return "".join([
+        "このチャンネルに関するデータがあります。\n",
+        f"チャンネルデータ: {to_prompt_text(analysis_data['target_channel_data'])}\n",
+        f"また、このチャンネルを登録しているユーザーが、他にも登録しているチャンネルとユーザーどのくらい重複しているか（重複度）、関係性を示すデータがあります。視聴者人気のチャンネルのデータ: {to_prompt_text(analysis_data['popular_channels_csv_data'])}\n",
+        "そこに記載された各チャンネルデータがあります。これを比較チャンネルといいます。\n",
+        f"比較チャンネルのデータ: {to_prompt_text(analysis_data['popular_channels_data'])}\n",
+    ])
+
 
-    prompt += "このチャンネルに関するデータがあります。\n"
-    prompt += f"チャンネルデータ: {analysis_data['target_channel_data']}\n"
-    prompt += f"また、このチャンネルを登録しているユーザーが、他にも登録しているチャンネルとユーザーどのくらい重複しているか（重複度）、関係性を示すデータがあります。視聴者人気のチャンネルのデータ: {analysis_data['popular_channels_csv_data']}\n"
-    prompt += f"そこに記載された各チャンネルデータがあります。これを比較チャンネルといいます。\n"
-    prompt += f"比較チャンネルのデータ: {analysis_data['popular_channels_data']}\n"
-    prompt += "これらのデータから、このチャンネルの視聴者層の特徴や、どのようなチャンネルであるか分析を詳細に報告してください。マークダウンで出力できるようにフォーマットをしてください。"
-    return prompt
+def __generate_popular_channels_prompt(user_input: str) -> str:
+    """
+    ユーザーの議題から、分析データ（system 側）に対する指示のプロンプトを生成
+    """
+    return "".join([
+        f"議題: '{user_input}'\n\n",
+        "これらのデータから、このチャンネルの視聴者層の特徴や、どのようなチャンネルであるか分析を詳細に報告してください。マークダウンで出力できるようにフォーマットをしてください。",
+    ])
 
 
 YOUTUBE_API_KEY = os.getenv("YOUTUBE_API_KEY")
@@ -305,7 +697,7 @@ def get_video_thumbnail(video_id: str) -> str:
 
     data = response.json()
 
-    print(f"video api data: {data}")
+    logger.debug("video api data: %s", data)
 
     if "items" not in data or len(data["items"]) == 0:
         raise HTTPException(status_code=404, detail="指定された動画が見つかりません")
@@ -317,7 +709,7 @@ def get_video_thumbnail(video_id: str) -> str:
     # 高画質のサムネイルを取得（利用可能なものを優先）
     thumbnail_url = thumbnails.get("high", {}).get("url")
 
-    print(f"thumbnail_url: {thumbnail_url}")
+    logger.debug("thumbnail_url: %s", thumbnail_url)
 
     if not thumbnail_url:
         raise HTTPException(status_code=404, detail="サムネイルが見つかりません")
@@ -331,7 +723,7 @@ async def analyze_thumbnail(video_id: str):
         raise HTTPException(status_code=400, detail="動画IDが必要です")
 
     # YouTube Data API でサムネイル URL を取得
-    print(f"video_id: {video_id}")
+    logger.debug("video_id: %s", video_id)
     thumbnail_url = get_video_thumbnail(video_id)
 
     # サムネイル画像にアクセス
@@ -0,0 +1,63 @@
+import os
+import time
+import asyncio
+import orjson
+import aiosqlite
+
+SESSION_STORE_PATH = os.getenv("SESSION_STORE_PATH", "sessions.sqlite3")
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", str(24 * 60 * 60)))
+
+
+class SessionStore:
+    """
+    議論の途中経過（履歴・発言回数・役割）を SQLite に保存するクラス
+    WebSocket が切断されても、同じ session_id で再接続すれば続きから再開できる
+    """
+
+    def __init__(self, path: str = SESSION_STORE_PATH, ttl_seconds: int = SESSION_TTL_SECONDS):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._db: aiosqlite.Connection | None = None
+        self._lock = asyncio.Lock()
+
+    async def load(self, session_id: str) -> dict | None:
+        db = await self.__get_db()
+        async with db.execute(
+            "SELECT state FROM sessions WHERE session_id = ? AND updated_at > ?",
+            (session_id, time.time() - self.ttl_seconds),
+        ) as cur:
+            row = await cur.fetchone()
+        return orjson.loads(row[0]) if row else None
+
+    async def save(self, session_id: str, state: dict):
+        db = await self.__get_db()
+        await db.execute(
+            "INSERT OR REPLACE INTO sessions (session_id, state, updated_at) VALUES (?, ?, ?)",
+            (session_id, orjson.dumps(state), time.time()),
+        )
+        await db.commit()
+
+    async def delete(self, session_id: str):
+        db = await self.__get_db()
+        await db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+        await db.commit()
+
+    async def close(self):
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+    async def __get_db(self) -> aiosqlite.Connection:
+        """
+        初回アクセス時に接続してテーブルを用意し、期限切れのセッションを掃除する
+        """
+        async with self._lock:
+            if self._db is None:
+                db = await aiosqlite.connect(self.path)
+                await db.execute(
+                    "CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, state BLOB NOT NULL, updated_at REAL NOT NULL)"
+                )
+                await db.execute("DELETE FROM sessions WHERE updated_at <= ?", (time.time() - self.ttl_seconds,))
+                await db.commit()
+                self._db = db
+            return self._db
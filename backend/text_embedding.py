@@ -0,0 +1,76 @@
+import os
+import asyncio
+import logging
+import threading
+import numpy as np
+
+logger = logging.getLogger("websocket_server")
+
+# 日本語の議題を扱うため多言語対応の小型モデルを既定にする
+EMBEDDING_MODEL_NAME = os.getenv(
+    "EMBEDDING_MODEL_NAME", "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+)
+# 推論バックエンド（"torch" / "onnx" / "openvino"）
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+
+
+class TextEmbedder:
+    """
+    ローカルの埋め込みモデルでテキストをベクトル化するクラス
+    モデルが読み込めない環境では embed() が None を返す
+    """
+
+    def __init__(self, model_name: str = EMBEDDING_MODEL_NAME, backend: str = EMBEDDING_BACKEND):
+        self.model_name = model_name
+        self.backend = backend
+        self._model = None
+        self._load_failed = False
+        self._lock = threading.Lock()
+
+    async def embed(self, text: str) -> np.ndarray | None:
+        """
+        正規化済みの埋め込みベクトルを返す（推論は CPU 処理なのでスレッドで実行）
+        """
+        return await asyncio.to_thread(self.__embed, text)
+
+    def __embed(self, text: str) -> np.ndarray | None:
+        model = self.__get_model()
+        if model is None:
+            return None
+        # モデルの入力長を超える部分は切り捨てられるため、分割して埋め込み、平均を取って全文を表す
+        vectors = model.encode(self.__split(model, text), normalize_embeddings=True)
+        vector = vectors.mean(axis=0)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    @staticmethod
+    def __split(model, text: str) -> list[str]:
+        """
+        モデルの最大入力長（特殊トークンの分を除く）ごとにテキストを分割する
+        """
+        window = max(model.max_seq_length - 2, 1)
+        token_ids = model.tokenizer(text, add_special_tokens=False)["input_ids"]
+        if len(token_ids) <= window:
+            return [text]
+        return [model.tokenizer.decode(token_ids[i:i + window]) for i in range(0, len(token_ids), window)]
+
+    def __get_model(self):
+        """
+        初回呼び出し時にモデルを読み込む
+        """
+        with self._lock:
+            if self._model is None and not self._load_failed:
+                try:
+                    from sentence_transformers import SentenceTransformer
+                    self._model = SentenceTransformer(self.model_name, backend=self.backend)
+                except Exception as e:
+                    logger.warning("埋め込みモデルの読み込みに失敗しました: %s", e)
+                    self._load_failed = True
+            return self._model
+
+
+def cosine_similarity(a: np.ndarray, b: np.ndarray) -> float:
+    """
+    正規化済みベクトル同士のコサイン類似度
+    """
+    return float(np.dot(a, b))
@@ -11,8 +11,48 @@ import { IconDownload, IconChevronDown } from '@tabler/icons-react';
 interface Message {
   sender: string; // 例: "User" | "GPT(3.5)" | "Gemini(2.0)" | "GPTまとめ"
   text: string;
+  streaming?: boolean; // ✅ トークン受信中の発言
 }
 
+/** ✅ サーバーからのメッセージ（delta: ストリーミング中の差分, done: 発言の確定） */
+interface ServerMessage {
+  sender: string;
+  text?: string;
+  delta?: string;
+  done?: boolean;
+  end?: boolean; // ✅ 議論が終わった（エラーで終わった場合は text にエラー内容が入る）
+}
+
+/** ✅ 異常切断から続けて再開を試みる回数の上限 */
+const MAX_RESUME_ATTEMPTS = 3;
+
+/** ✅ 正常終了（サーバーが処理を終えて閉じた）を表すクローズコード */
+const NORMAL_CLOSURE = 1000;
+
+const textEncoder = new TextEncoder();
+const textDecoder = new TextDecoder();
+
+/** ✅ バイナリフレームで JSON を送信する */
+const sendPayload = (payload: object) => {
+  WebSocketManager.socketInstance?.send(textEncoder.encode(JSON.stringify(payload)));
+};
+
+/** ✅ ストリーミング中の発言に差分を連結し、確定メッセージで置き換える */
+const mergeMessage = (prev: Message[], data: ServerMessage): Message[] => {
+  const last = prev[prev.length - 1];
+  const isStreamingSameSender = last?.streaming && last.sender === data.sender;
+
+  if (data.delta !== undefined) {
+    if (isStreamingSameSender) {
+      return [...prev.slice(0, -1), { ...last, text: last.text + data.delta }];
+    }
+    return [...prev, { sender: data.sender, text: data.delta, streaming: true }];
+  }
+
+  const message = { sender: data.sender, text: data.text ?? "" };
+  return isStreamingSameSender ? [...prev.slice(0, -1), message] : [...prev, message];
+};
+
 export default function Magi() {
   const [messages, setMessages] = useState<Message[]>([]);
   const [isConnected, setIsConnected] = useState(false);
@@ -22,6 +62,9 @@ export default function Magi() {
   const [videoId, setVideoId] = useState("");
   const [channelId, setChannelId] = useState("");
   const messagesEndRef = useRef<HTMLDivElement | null>(null);
+  const pendingPayload = useRef<object | null>(null); // ✅ 実行中の議論（切断時の再開用）
+  const resumeAttempts = useRef(0); // ✅ 発言が確定しないまま再開を試みた回数
+  const shouldResume = useRef(false); // ✅ 直前の切断が異常切断だったか
 
   /** ✅ メッセージが追加されるたびにスクロール */
   const viewport = useRef<HTMLDivElement>(null);
@@ -37,19 +80,63 @@ export default function Magi() {
 
     const messageListener = (event: MessageEvent) => {
       try {
-        const data = JSON.parse(event.data) as Message;
-        setMessages((prev) => [...prev, data]);
+        const raw = typeof event.data === "string" ? event.data : textDecoder.decode(event.data);
+        const data = JSON.parse(raw) as ServerMessage;
+        if (data.end) {
+          pendingPayload.current = null;
+          if (data.text) {
+            setMessages((prev) => mergeMessage(prev, data));
+          }
+          setLoading(false);
+          return;
+        }
+        if (data.done) {
+          resumeAttempts.current = 0;
+        }
+        setMessages((prev) => mergeMessage(prev, data));
         setLoading(false);
       } catch (error) {
         console.error("メッセージのパースエラー:", error);
       }
     };
 
+    /** ✅ 正常終了なら再開しない（サーバーは処理を終えている） */
+    const closeListener = (event: CloseEvent) => {
+      shouldResume.current = event.code !== NORMAL_CLOSURE;
+      if (!shouldResume.current && pendingPayload.current) {
+        pendingPayload.current = null;
+        setLoading(false);
+      }
+    };
+
+    /** ✅ 議論の途中で異常切断して再接続した場合は、同じ sessionId で送り直して続きから再開する */
+    const openListener = () => {
+      if (!pendingPayload.current || !shouldResume.current) return;
+      shouldResume.current = false;
+
+      if (resumeAttempts.current >= MAX_RESUME_ATTEMPTS) {
+        pendingPayload.current = null;
+        resumeAttempts.current = 0;
+        setMessages((prev) => [...prev, { sender: "system", text: "議論を再開できませんでした" }]);
+        setLoading(false);
+        return;
+      }
+
+      resumeAttempts.current += 1;
+      // 受信途中だった発言はサーバー側で最初から生成し直される
+      setMessages((prev) => (prev[prev.length - 1]?.streaming ? prev.slice(0, -1) : prev));
+      sendPayload(pendingPayload.current);
+    };
+
     WebSocketManager.addListener(messageListener);
+    WebSocketManager.addOpenListener(openListener);
+    WebSocketManager.addCloseListener(closeListener);
     setIsConnected(true);
 
     return () => {
       WebSocketManager.removeListener(messageListener);
+      WebSocketManager.removeOpenListener(openListener);
+      WebSocketManager.removeCloseListener(closeListener);
     };
   }, []);
 
@@ -61,11 +148,14 @@ export default function Magi() {
         analysisType: analysisType !== "none" ? analysisType : undefined,
         videoId: analysisType === "comment_analysis" ? videoId : undefined,
         channelId: analysisType === "channel_subscriber_popular_channel" ? channelId : undefined,
+        sessionId: crypto.randomUUID(),
       };
 
       console.log("送信データ:", payload);
       setMessages((prev) => [...prev, { sender: "User", text: topic }]);
-      WebSocketManager.socketInstance.send(JSON.stringify(payload));
+      pendingPayload.current = payload;
+      resumeAttempts.current = 0;
+      sendPayload(payload);
       setTopic("");
       setLoading(true);
     } else {
@@ -84,7 +174,7 @@ export default function Magi() {
 
     return (
       <Group
-        key={`${msg.sender}-${msg.text}-${index}`}
+        key={`${msg.sender}-${index}`}
         align="flex-start"
         justify={isUser ? "flex-end" : "flex-start"}
         gap="xs"
@@ -275,7 +365,7 @@ export default function Magi() {
           {messages.map((msg, idx) => renderMessage(msg, idx))}
         </ScrollArea>
 
-        {messages.length > 0 && messages[messages.length - 1].sender === "GPTまとめ" && (
+        {messages.length > 0 && messages[messages.length - 1].sender === "GPTまとめ" && !messages[messages.length - 1].streaming && (
           <Button
             variant="filled"
             color="red"
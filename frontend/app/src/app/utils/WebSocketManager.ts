@@ -2,6 +2,8 @@ class WebSocketManager {
   private static instance: WebSocketManager;
   private socket: WebSocket | null = null;
   private listeners: ((message: MessageEvent) => void)[] = [];
+  private openListeners: (() => void)[] = [];
+  private closeListeners: ((event: CloseEvent) => void)[] = [];
   private connectionStatus: boolean = false;
 
   private constructor() {}
@@ -20,10 +22,12 @@ class WebSocketManager {
 
     console.log("WebSocket: 接続開始");
     this.socket = new WebSocket(url);
+    this.socket.binaryType = "arraybuffer"; // ✅ サーバーは JSON をバイナリフレームで送信する
 
     this.socket.onopen = () => {
       console.log("WebSocket: 接続成功");
       this.connectionStatus = true;
+      this.openListeners.forEach((listener) => listener());
     };
 
     this.socket.onmessage = (event) => {
@@ -38,6 +42,7 @@ class WebSocketManager {
       console.log("WebSocket: 切断", event);
       this.connectionStatus = false;
       this.socket = null;
+      this.closeListeners.forEach((listener) => listener(event));
       setTimeout(() => this.connect(url), 3000); // 3秒後に再接続
     };
   }
@@ -50,6 +55,24 @@ class WebSocketManager {
     this.listeners = this.listeners.filter((l) => l !== listener);
   }
 
+  /** ✅ 接続（再接続を含む）が確立したときに呼ばれるリスナー */
+  addOpenListener(listener: () => void) {
+    this.openListeners.push(listener);
+  }
+
+  removeOpenListener(listener: () => void) {
+    this.openListeners = this.openListeners.filter((l) => l !== listener);
+  }
+
+  /** ✅ 接続が切れたときに呼ばれるリスナー（正常終了かどうかは event.code で判定する） */
+  addCloseListener(listener: (event: CloseEvent) => void) {
+    this.closeListeners.push(listener);
+  }
+
+  removeCloseListener(listener: (event: CloseEvent) => void) {
+    this.closeListeners = this.closeListeners.filter((l) => l !== listener);
+  }
+
   close() {
     if (this.socket) {
       this.socket.close();